@@ -1,18 +1,37 @@
 import asyncio
+import atexit
+import hashlib
+import itertools
 import logging
+import mmap
 import os
+import queue
 import subprocess
 import re
-import base64
 import zipfile
 import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 from uuid import uuid4
 from PIL import Image  # Нужно установить: pip install Pillow
+try:
+    import pybase64 as base64  # SIMD-декодер, API совместим со stdlib
+except ImportError:
+    import base64
+import httpx  # ставится вместе с python-telegram-bot
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -21,188 +40,561 @@ from telegram.ext import (
     ContextTypes,
 )
 from storage import UserSettings
+from calibre_pool import LOW_PRIORITY, CalibrePool
+try:
+    from fb2 import FB2Reader, first_binary_image  # Нужен lxml
+except ImportError:
+    FB2Reader = first_binary_image = None
 
 load_dotenv()
 
+# Временные файлы можно вынести в tmpfs (например, /dev/shm/kindlegarden),
+# чтобы не изнашивать SD-карту. Абсолютный путь считаем один раз
+TMP_DIR = os.path.abspath(os.getenv("KG_TMP_DIR", "tmp"))
+
+Path("logs").mkdir(exist_ok=True)
+Path(TMP_DIR).mkdir(parents=True, exist_ok=True)
+Path("data").mkdir(exist_ok=True)
+
+# Запись в файл и консоль идёт в отдельном потоке: воркеры и обработчики
+# только кладут запись в очередь и не ждут диск
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(
+    log_queue,
+    # Ротация: лог не растёт бесконечно (5 архивов по 10 МБ)
+    RotatingFileHandler("logs/bot.log", maxBytes=10 * 1024 * 1024, backupCount=5,
+                        encoding="utf-8", delay=True),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
-    handlers=[
-        logging.FileHandler("logs/bot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-Path("logs").mkdir(exist_ok=True)
-Path("tmp").mkdir(exist_ok=True)
-Path("data").mkdir(exist_ok=True)
+# Постоянные тексты ответов
+SEND_BOOK_TEXT = (
+    "📎 Отправьте FB2 или EPUB файл\n"
+    "Максимальный размер: 50 МБ\n\n"
+    "✅ <b>Новые возможности:</b>\n"
+    "• Заполнение названия и автора\n"
+    "• Оптимизация обложек\n"
+    "• Лучшие миниатюры для Kindle"
+)
+FALLBACK_TEXT = "Используйте меню ниже 👇"
+READY_TEXT = "Файл готов для Kindle! 📚"
+UNSUPPORTED_FORMAT_TEXT = (
+    "⚠️ Поддерживаются только:\n"
+    "• FB2 (.fb2)\n"
+    "• FB2.ZIP (.fb2.zip)\n"
+    "• EPUB (.epub)"
+)
+TOO_LARGE_TEXT = "⚠️ Максимальный размер файла - 50 МБ"
+ALREADY_IN_FORMAT_TEXT = (
+    "✅ Книга уже в формате EPUB, конвертация не нужна\n"
+    "Для Kindle выберите AZW3 в ⚙️ Настройках"
+)
+
+SUPPORTED_EXTS = ('.fb2', '.fb2.zip', '.epub')
+# Строки stderr Calibre, которые не являются ошибкой
+STDERR_IGNORE_PREFIXES = ("Usage:",)
+
+# Статус "Конвертирую" показываем, только если книга ждала в очереди дольше (с)
+STATUS_EDIT_MIN_WAIT = 1.0
+
+# Лимит подписи к документу в Telegram
+CAPTION_LIMIT = 1024
+
+# Размер куска при потоковом скачивании книги
+DOWNLOAD_CHUNK = 64 * 1024
+
+# Фильтр уменьшения обложки: после draft() и thumbnail() разница с LANCZOS
+# на экране Kindle не видна, а ядро вдвое короче
+COVER_RESAMPLE = Image.Resampling.BICUBIC
+
+# Символы, недопустимые в имени файла: str.translate убирает их за один проход
+UNSAFE_FILENAME_CHARS = str.maketrans("", "", '<>:"/\\|?*')
+
+# Регулярные выражения, которые используются на каждую книгу
+EBOOK_META_RE = re.compile(r"^(Title|Author\(s\)|Series)\s*:\s*(.+?)\s*$", re.MULTILINE)
+AUTHOR_SORT_RE = re.compile(r"\s*\[[^\]]*\]$")
+FB2_BINARY_RE = re.compile(
+    rb'<binary[^>]+content-type="image/[^"]+"[^>]*>([^<]+)</binary>',
+    re.IGNORECASE
+)
+
+# Разрешённые пользователи (через запятую). Пусто - бот открыт для всех
+ALLOWED_USERS: frozenset[int] = frozenset(
+    int(uid) for uid in os.getenv("TELEGRAM_ALLOWED_USERS", "").split(",") if uid.strip()
+)
 
-conversion_queue = asyncio.Queue(maxsize=5)
+# ebook-convert однопоточный, поэтому книги разных пользователей конвертируем параллельно
+CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS", "0")) or min(os.cpu_count() or 1, 3)
+QUEUE_SIZE = 5 * CONVERSION_WORKERS
+
+# Приоритет книги - время постановки плюс штраф за размер: маленькие книги
+# обгоняют большие, но не больше чем на MAX_SIZE_DELAY секунд. Книга,
+# поставленная позже, чем через MAX_SIZE_DELAY, большую уже не обгонит
+SIZE_DELAY_PER_MB = 20
+MAX_SIZE_DELAY = 300
+
+# Calibre на большой книге берёт сотни МБ: при нехватке памяти конвертация ждёт,
+# иначе OOM killer может убить весь бот, а не только ebook-convert
+MIN_FREE_MEMORY = int(os.getenv("MIN_FREE_MEMORY_MB", "250")) * 1024 * 1024
+MEMORY_WAIT_LIMIT = 120
+
+# KG_FAST=1 пропускает необязательные проходы Calibre по всему тексту книги.
+# Эвристики и так выключены по умолчанию, а сжатие MOBI/AZW3 не используется
+FAST_CONVERSION = os.getenv("KG_FAST", "0") == "1"
+
+# Тексты меню собираются один раз при импорте
+START_TEXT = (
+    "📚 <b>KindleGarden Bot v3</b>\n\n"
+    "<b>Улучшенная конвертация с метаданными!</b>\n\n"
+    "✅ <b>Что нового:</b>\n"
+    "• Правильное заполнение названия и автора\n"
+    "• Оптимизация обложек для Kindle\n"
+    "• Лучшая поддержка миниатюр\n\n"
+    "<b>Форматы:</b>\n"
+    "• FB2 / FB2.ZIP\n"
+    "• EPUB\n\n"
+    "<b>Совет:</b> Используйте AZW3 для новых Kindle\n"
+    "для гарантированного отображения обложек."
+)
+HELP_TEXT = (
+    "📚 <b>KindleGarden - помощь</b>\n\n"
+
+    "✅ <b>Как работают метаданные и обложки:</b>\n"
+    "1. Бот извлекает название, автора и обложку\n"
+    "2. Оптимизирует обложку для Kindle (800x1200)\n"
+    "3. Встраивает метаданные в книгу\n"
+    "4. Использует специальные настройки для миниатюр\n\n"
+
+    "🖼️ <b>Почему миниатюра может не отображаться:</b>\n"
+    "• <b>MOBI</b>: Требуется отправка через email с темой 'convert'\n"
+    "• <b>AZW3</b>: Обычно работает через USB\n"
+    "• Размер обложки менее 600x800 пикселей\n"
+    "• Старый Kindle (до 5 поколения)\n\n"
+
+    "⚙️ <b>Рекомендации по форматам:</b>\n"
+    "• <b>AZW3</b> - лучшая поддержка, новые Kindle\n"
+    "• <b>MOBI</b> - старые Kindle, отправка через email\n"
+    "• <b>EPUB</b> - другие устройства\n\n"
+
+    "📧 <b>Для MOBI миниатюр:</b>\n"
+    "Отправьте файл на email Kindle\n"
+    "Тема письма: <code>convert</code>\n"
+    "Или используйте Calibre\n\n"
+
+    "⏱️ <b>Ограничения:</b>\n"
+    "• Размер: до 50 МБ\n"
+    "• Время: до 5 минут\n"
+    f"• Очередь: {QUEUE_SIZE} файлов"
+)
+SETTINGS_TIPS_TEXT = (
+    "<b>Советы по миниатюрам:</b>\n"
+    "• AZW3 - миниатюры через USB\n"
+    "• MOBI - миниатюры через email\n"
+    "• EPUB - без гарантий для Kindle"
+)
+# Описание форматов с советами по миниатюрам
+FORMATS_INFO = {
+    "azw3": "📘 AZW3 - лучшие миниатюры (USB, новые Kindle)",
+    "mobi": "📙 MOBI - совместимость (email, старые Kindle)",
+    "epub": "📖 EPUB - другие читалки"
+}
+# Клавиатура настроек для каждого текущего формата: собираются один раз
+# callback_data кнопок выбора формата -> формат. Заодно это белый список:
+# произвольная строка из callback не попадёт в настройки и пути файлов
+FORMAT_CALLBACKS = {f"setfmt:{fmt}": fmt for fmt in FORMATS_INFO}
+
+SETTINGS_KEYBOARDS = {
+    current: InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            f"{'✅ ' if fmt == current else ''}{desc}",
+            callback_data=f"setfmt:{fmt}"
+        )] for fmt, desc in FORMATS_INFO.items()
+    ])
+    for current in FORMATS_INFO
+}
+# Совет после смены формата
+FORMAT_ADVICE = {
+    "mobi": "\n\n⚠️ <b>Для миниатюр MOBI:</b>\nОтправляйте файлы на email Kindle\nс темой 'convert'",
+    "azw3": "\n\n✅ <b>Для миниатюр AZW3:</b>\nИспользуйте USB кабель\nили Calibre для копирования",
+    "epub": "\n\n📖 <b>Для EPUB:</b>\nФормат для других устройств,\nне гарантирует миниатюры на Kindle"
+}
+# Подсказка о формате в сообщении о постановке в очередь
+QUEUED_FORMAT_ADVICE = {
+    "azw3": "AZW3 (миниатюры через USB)",
+    "mobi": "MOBI (миниатюры через email)",
+    "epub": "EPUB (другие устройства)"
+}
+
+# Маленькие книги конвертируются за секунды, поэтому идут первыми и не ждут
+# за большими (см. task_priority); счётчик сохраняет порядок при равенстве.
+# От каждого пользователя в очереди не больше одной книги (см. user_backlogs),
+# поэтому лимит QUEUE_SIZE проверяется в handle_document по queued_books()
+conversion_queue = asyncio.PriorityQueue()
+queue_counter = itertools.count()
+# Задачи в очереди и в работе; размер ограничен QUEUE_SIZE + число воркеров
 active_tasks = {}
+# Пользователь -> его следующие книги по порядку отправки. Ключ есть, пока у
+# пользователя есть книга в conversion_queue или в работе: так книги одного
+# пользователя идут строго по очереди, а свободный воркер не ждёт занятого
+# пользователя и берёт книгу другого
+user_backlogs: dict[int, deque] = {}
+# Одновременно идёт не больше CONVERSION_WORKERS конвертаций; лишний воркер
+# тем временем скачивает следующую книгу и читает её метаданные
+convert_slots = asyncio.Semaphore(CONVERSION_WORKERS)
 settings_db = UserSettings()
 
-MAIN_REPLY_KEYBOARD = ReplyKeyboardMarkup(
-    [["📚 Отправить книгу", "⚙️ Настройки", "❓ Помощь"]],
+class StaticReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    """Неизменяемая клавиатура: сериализуется в dict один раз и переиспользуется"""
+    __slots__ = ("_cached_dict",)
+
+    def to_dict(self, recursive: bool = True) -> dict:
+        if not recursive:
+            return super().to_dict(recursive=False)
+        try:
+            return self._cached_dict
+        except AttributeError:
+            self._cached_dict = super().to_dict()
+            return self._cached_dict
+
+
+BTN_SEND_BOOK = "📚 Отправить книгу"
+BTN_SETTINGS = "⚙️ Настройки"
+BTN_HELP = "❓ Помощь"
+
+MAIN_REPLY_KEYBOARD = StaticReplyKeyboardMarkup(
+    [[BTN_SEND_BOOK, BTN_SETTINGS, BTN_HELP]],
     resize_keyboard=True,
     one_time_keyboard=False
 )
 
 
-def is_zip_file(path: str) -> bool:
-    """Проверяет, является ли файл ZIP по сигнатуре (а не по расширению)"""
+def allowlisted(handler):
+    """Молча игнорирует обновления от пользователей не из ALLOWED_USERS"""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if ALLOWED_USERS:
+            user = update.effective_user
+            if user is None or user.id not in ALLOWED_USERS:
+                return
+        await handler(update, context)
+    return wrapper
+
+
+def _size_or_zero(path: str) -> int:
+    """Размер файла одним stat(); 0 если файла нет"""
     try:
-        with open(path, "rb") as f:
-            return f.read(4) == b"PK\x03\x04"
-    except:
-        return False
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def sniff_bytes(buf: bytes) -> str:
+    """Определяет тип файла по первым байтам: zip, fb2 или unknown"""
+    if buf.startswith(b"PK\x03\x04"):
+        return "zip"
+    if buf.startswith((b"\xff\xfe", b"\xfe\xff")):
+        # FB2 в UTF-16: BOM задаёт порядок байт, сигнатуры ищем в тексте
+        buf = buf.decode("utf-16", errors="ignore").encode("ascii", errors="ignore")
+    if b"<?xml" in buf or b"<FictionBook" in buf:
+        return "fb2"
+    return "unknown"
+
+
+def _sniff(path: str) -> str:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return "unknown"
+    try:
+        return sniff_bytes(os.read(fd, 64))
+    finally:
+        os.close(fd)
 
 
 def unpack_if_needed(input_path: str) -> str:
     """Распаковывает FB2.ZIP в чистый FB2, возвращает путь к распакованному файлу"""
-    input_p = Path(input_path)
-    
-    if not is_zip_file(input_path):
+    # Сигнатура ZIP в первых байтах вместо поиска каталога в конце файла
+    if _sniff(input_path) != "zip":
         logger.info(f"Файл не является архивом: {input_path}")
         return input_path
     
     logger.info(f"Распаковка архива: {input_path}")
     try:
         with zipfile.ZipFile(input_path, "r") as zf:
-            fb2_files = [f for f in zf.namelist() if f.lower().endswith(".fb2")]
-            if not fb2_files:
+            # next() останавливается на первом .fb2 (обычно это первый же файл),
+            # а open(ZipInfo) не ищет имя повторно
+            infos = zf.infolist()
+            target = next((i for i in infos if i.filename.lower().endswith(".fb2")), None)
+            if target is None:
                 raise ValueError("В архиве не найден файл .fb2")
             
-            extracted_path = input_p.with_suffix(".unpacked.fb2")
-            with zf.open(fb2_files[0]) as src, open(extracted_path, "wb") as dst:
-                dst.write(src.read())
+            extracted_path = os.path.splitext(input_path)[0] + ".unpacked.fb2"
+            with zf.open(target) as src, open(extracted_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
             
             logger.info(f"Распаковано: {extracted_path}")
-            return str(extracted_path)
+            return extracted_path
     except Exception as e:
         logger.error(f"Ошибка распаковки: {e}")
         return input_path
 
 
-def extract_metadata(input_path: str) -> dict:
-    """Извлекает метаданные из книги"""
+async def run_process(cmd: list[str], timeout: float, capture_stdout: bool = True) -> tuple[int, str, str]:
+    """Запускает процесс без блокировки event loop; по таймауту убивает его.
+
+    Без capture_stdout вывод уходит в /dev/null, а вместо него возвращается "".
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
     try:
-        result = subprocess.run(
-            ["ebook-meta", input_path],
-            capture_output=True,
-            text=True,
-            timeout=30,
-            encoding='utf-8',
-            errors='replace'
-        )
-        
-        metadata = {
-            "title": "Без названия", 
-            "authors": ["Неизвестен"],
-            "series": None,
-            "series_index": None
-        }
-        
-        for line in result.stdout.splitlines():
-            line = line.strip()
-            if line.startswith("Title:"):
-                val = line[6:].strip()
-                if val and val.lower() != "unknown" and val:
-                    metadata["title"] = val
-            elif line.startswith("Author(s):"):
-                val = line[10:].strip()
-                if val and val.lower() != "unknown" and val:
-                    metadata["authors"] = [a.strip() for a in val.split(",")]
-            elif line.startswith("Series:"):
-                val = line[7:].strip()
-                if val and val.lower() != "unknown" and val:
-                    metadata["series"] = val
-            elif line.startswith("Series Index:"):
-                val = line[13:].strip()
-                if val:
-                    metadata["series_index"] = val
-        
-        return metadata
-        
-    except Exception as e:
-        logger.warning(f"Ошибка извлечения метаданных: {e}")
-        return {
-            "title": "Без названия", 
-            "authors": ["Неизвестен"],
-            "series": None,
-            "series_index": None
-        }
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return (
+        proc.returncode,
+        stdout.decode("utf-8", errors="replace") if stdout else "",
+        stderr.decode("utf-8", errors="replace")
+    )
+
+
+# Пул процессов calibre-debug, если он есть в системе (см. post_init)
+calibre_pool = None
 
+# HTTP-клиент для потокового скачивания книг (см. post_init)
+download_client = None
 
-def extract_cover(input_path: str, cover_path: str) -> bool:
-    """Извлекает обложку из книги"""
+# get_metadata из Calibre, если его удалось импортировать (см. load_calibre_metadata_api)
+calibre_get_metadata = None
+
+# Столько же, сколько было у ebook-meta: дольше книгу разбирать незачем
+METADATA_TIMEOUT = 30
+
+
+def load_calibre_metadata_api():
+    """Подключает API метаданных Calibre в процесс бота (раскладка пакета Debian/Ubuntu)"""
+    lib = os.getenv("CALIBRE_PYTHON_PATH", "/usr/lib/calibre")
+    if not os.path.isdir(lib):
+        return None
+    added_path = lib not in sys.path
+    if added_path:
+        sys.path.append(lib)
+    # То же, что выставляют запускающие скрипты ebook-meta/ebook-convert
+    location_attrs = ()
+    if not hasattr(sys, "resources_location"):
+        sys.resources_location = os.getenv("CALIBRE_RESOURCES_PATH", "/usr/share/calibre")
+        sys.extensions_location = os.getenv("CALIBRE_EXTENSIONS_PATH", os.path.join(lib, "calibre", "plugins"))
+        sys.executables_location = os.getenv("CALIBRE_EXECUTABLES_PATH", "/usr/bin")
+        sys.system_plugins_location = None
+        location_attrs = ("resources_location", "extensions_location",
+                          "executables_location", "system_plugins_location")
     try:
-        # Метод 1: через ebook-meta
+        from calibre.ebooks.metadata.meta import get_metadata
+        return get_metadata
+    except Exception as e:
+        logger.info(f"API Calibre недоступно, метаданные через ebook-meta: {e}")
+        # Не оставляем в процессе следов неудачного импорта
+        if added_path:
+            sys.path.remove(lib)
+        for attr in location_attrs:
+            delattr(sys, attr)
+        for name in [m for m in sys.modules if m == "calibre" or m.startswith("calibre.")]:
+            del sys.modules[name]
+        return None
+
+
+def run_in_daemon_thread(func, *args) -> asyncio.Future:
+    """Запускает func в отдельном daemon-потоке и возвращает future с результатом.
+
+    В отличие от to_thread, зависший вызов не занимает поток общего пула
+    и не держит процесс при остановке.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if future.done():  # future отменил wait_for по таймауту
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
         try:
-            result = subprocess.run(
-                ["ebook-meta", input_path, "--get-cover", cover_path],
-                capture_output=True,
-                timeout=30
-            )
-            
-            if Path(cover_path).exists() and Path(cover_path).stat().st_size > 1000:
-                logger.info(f"Обложка извлечена ebook-meta: {Path(cover_path).stat().st_size} байт")
-                return True
+            result, error = func(*args), None
         except Exception as e:
-            logger.debug(f"ebook-meta не сработал: {e}")
-        
-        # Метод 2: для FB2 - ручной парсинг
-        if input_path.lower().endswith('.fb2'):
+            result, error = None, e
+        loop.call_soon_threadsafe(settle, result, error)
+
+    threading.Thread(target=target, name="kg-calibre-meta", daemon=True).start()
+    return future
+
+
+def read_metadata_inprocess(path: str):
+    """Читает метаданные книги через API Calibre без запуска ebook-meta"""
+    with open(path, "rb") as f:
+        return calibre_get_metadata(f, os.path.splitext(path)[1].lower().lstrip("."), force_read_metadata=True)
+
+
+def _known(val) -> bool:
+    return bool(val) and str(val).strip().lower() != "unknown"
+
+
+def default_metadata() -> dict:
+    return {
+        "title": "Без названия",
+        "authors": ["Неизвестен"],
+        "series": None,
+        "series_index": None
+    }
+
+
+def metadata_from_calibre(mi) -> dict:
+    """Метаданные из объекта Metadata Calibre"""
+    authors = [a.strip() for a in (mi.authors or []) if _known(a)]
+    return {
+        "title": mi.title.strip() if _known(mi.title) else "Без названия",
+        "authors": authors or ["Неизвестен"],
+        "series": mi.series if _known(mi.series) else None,
+        "series_index": mi.series_index if mi.series else None
+    }
+
+
+def parse_ebook_meta(stdout: str) -> dict:
+    """Метаданные из вывода ebook-meta"""
+    metadata = default_metadata()
+    # Вывод ebook-meta: "Title               : Книга", "Author(s)           : Автор [Сортировка]",
+    # "Series              : Серия #2" - разбираем одним проходом регулярного выражения
+    for m in EBOOK_META_RE.finditer(stdout):
+        key, val = m.group(1), m.group(2)
+        if not _known(val):
+            continue
+        if key == "Title":
+            metadata["title"] = val
+        elif key == "Author(s)":
+            authors = [AUTHOR_SORT_RE.sub("", a) for a in val.split(" & ")]
+            metadata["authors"] = [a for a in authors if a]
+        else:
+            series, sep, index = val.rpartition(" #")
+            metadata["series"] = series if sep else val
+            metadata["series_index"] = index if sep else None
+    return metadata
+
+
+def _first_binary_image_re(input_path: str, min_size: int):
+    """Запасной вариант без lxml: поиск <binary> регулярным выражением"""
+    if _size_or_zero(input_path) == 0:
+        return None
+    # Теги и base64 - чистый ASCII, поэтому ищем прямо по байтам. mmap вместо
+    # read(): ядро подгружает только просмотренные страницы, копии книги в памяти нет
+    with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        for match in FB2_BINARY_RE.finditer(content):
             try:
-                with open(input_path, 'rb') as f:
-                    content = f.read()
-                
-                # Пробуем разные кодировки
-                text = None
-                for encoding in ['utf-8', 'cp1251', 'koi8-r']:
-                    try:
-                        text = content.decode(encoding)
-                        break
-                    except:
-                        continue
-                
-                if text is None:
-                    text = content.decode('utf-8', errors='ignore')
-                
-                # Ищем все binary с изображениями
-                pattern = r'<binary[^>]+content-type="image/[^"]+"[^>]*>([^<]+)</binary>'
-                matches = re.findall(pattern, text, re.IGNORECASE)
-                
-                for match in matches:
-                    try:
-                        image_data = base64.b64decode(match.strip())
-                        if len(image_data) > 5000:  # Минимальный размер
-                            with open(cover_path, 'wb') as f:
-                                f.write(image_data)
-                            
-                            if Path(cover_path).stat().st_size > 1000:
-                                logger.info(f"Обложка извлечена из FB2: {Path(cover_path).stat().st_size} байт")
-                                return True
-                    except Exception as e:
-                        logger.debug(f"Не удалось декодировать обложку: {e}")
-                        continue
-            except Exception as e:
-                logger.debug(f"Ошибка при парсинге FB2: {e}")
-        
+                image_data = base64.b64decode(match.group(1).strip())
+            except ValueError as e:
+                logger.debug(f"Не удалось декодировать обложку: {e}")
+                continue
+            if len(image_data) > min_size:
+                return image_data
+    return None
+
+
+async def extract_metadata_and_cover(input_path: str, cover_path: str) -> tuple[dict, bool]:
+    """Извлекает метаданные и обложку книги одним обращением к Calibre"""
+    metadata, has_cover = None, False
+    
+    # API Calibre в процессе бота: метаданные и обложка без запуска ebook-meta
+    global calibre_get_metadata
+    if calibre_get_metadata is not None:
+        try:
+            mi = await asyncio.wait_for(
+                run_in_daemon_thread(read_metadata_inprocess, input_path), METADATA_TIMEOUT
+            )
+            metadata = metadata_from_calibre(mi)
+            cover = mi.cover_data[1] if mi.cover_data else None
+            if cover and len(cover) > 1000:
+                await asyncio.to_thread(Path(cover_path).write_bytes, cover)
+                logger.info(f"Обложка извлечена API Calibre: {len(cover)} байт")
+                has_cover = True
+        except asyncio.TimeoutError:
+            # Поток с зависшим разбором не остановить: больше API не доверяем,
+            # а ebook-meta по таймауту просто убивается
+            calibre_get_metadata = None
+            logger.warning(f"API Calibre не прочитал метаданные за {METADATA_TIMEOUT} с, "
+                           f"дальше только ebook-meta")
+        except Exception as e:
+            logger.debug(f"API Calibre не прочитал метаданные, пробую ebook-meta: {e}")
+    
+    # Один запуск ebook-meta печатает метаданные и сразу сохраняет обложку
+    if metadata is None:
+        try:
+            _, stdout, _ = await run_process(
+                ["ebook-meta", input_path, "--get-cover", cover_path], timeout=30
+            )
+            metadata = parse_ebook_meta(stdout)
+            cover_size = _size_or_zero(cover_path)
+            if cover_size > 1000:
+                logger.info(f"Обложка извлечена ebook-meta: {cover_size} байт")
+                has_cover = True
+        except Exception as e:
+            logger.warning(f"Ошибка извлечения метаданных: {e}")
+            metadata = default_metadata()
+    
+    if not has_cover:
+        has_cover = await extract_fb2_cover(input_path, cover_path)
+    return metadata, has_cover
+
+
+async def extract_fb2_cover(input_path: str, cover_path: str) -> bool:
+    """Для FB2 без <coverpage> берёт первую достаточно большую картинку из <binary>"""
+    if not input_path.lower().endswith('.fb2'):
         return False
-        
+    try:
+        # С lxml разбор потоковый: книга целиком в память не читается
+        find_image = first_binary_image or _first_binary_image_re
+        image_data = await asyncio.to_thread(find_image, input_path, 5000)
+        if image_data:
+            await asyncio.to_thread(Path(cover_path).write_bytes, image_data)
+            logger.info(f"Обложка извлечена из FB2: {len(image_data)} байт")
+            return True
     except Exception as e:
-        logger.error(f"Ошибка извлечения обложки: {e}")
-        return False
+        logger.debug(f"Ошибка при парсинге FB2: {e}")
+    return False
 
 
 def optimize_cover_for_kindle(cover_path: str) -> bool:
-    """Оптимизирует обложку для Kindle"""
+    """Оптимизирует обложку для Kindle; вызывающий уже проверил, что файл не пустой"""
     try:
-        if not Path(cover_path).exists():
-            return False
+        # Оптимальные размеры для Kindle
+        # Минимум 600x800 для хорошего отображения
+        target_width = 800
+        target_height = 1200
         
         with Image.open(cover_path) as img:
+            # Image.open читает только заголовок. Если это уже RGB JPEG в пределах
+            # целевого размера - перекодирование лишь потеряет качество
+            if (img.format == 'JPEG' and img.mode == 'RGB'
+                    and img.width <= target_width and img.height <= target_height):
+                logger.info(f"Обложка уже подходит для Kindle: {img.width}x{img.height}")
+                return True
+            
+            # Для JPEG libjpeg сразу декодирует в уменьшенном масштабе (1/2..1/8),
+            # не разворачивая огромную обложку целиком. Для других форматов no-op
+            img.draft('RGB', (target_width, target_height))
+            
             # Конвертируем в RGB если нужно
             if img.mode in ('RGBA', 'LA', 'P'):
                 rgb_img = Image.new('RGB', img.size, (255, 255, 255))
@@ -211,20 +603,16 @@ def optimize_cover_for_kindle(cover_path: str) -> bool:
                 rgb_img.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
                 img = rgb_img
             
-            # Оптимальные размеры для Kindle
-            # Минимум 600x800 для хорошего отображения
-            target_width = 800
-            target_height = 1200
-            
             # Сохраняем пропорции
-            img.thumbnail((target_width, target_height), Image.Resampling.LANCZOS)
+            img.thumbnail((target_width, target_height), COVER_RESAMPLE)
             
-            # Сохраняем в высоком качестве
+            # Сохраняем в высоком качестве. Без optimize=True: второй проход по
+            # таблицам Хаффмана почти удваивает время сохранения ради пары процентов
             optimized_path = cover_path.replace('.jpg', '_optimized.jpg')
-            img.save(optimized_path, 'JPEG', quality=90, optimize=True)
+            img.save(optimized_path, 'JPEG', quality=90)
             
-            # Заменяем оригинальную обложку
-            shutil.move(optimized_path, cover_path)
+            # Заменяем оригинальную обложку: каталог тот же, хватает одного rename()
+            os.replace(optimized_path, cover_path)
             
             logger.info(f"Обложка оптимизирована: {img.size[0]}x{img.size[1]}")
             return True
@@ -234,7 +622,53 @@ def optimize_cover_for_kindle(cover_path: str) -> bool:
         return False
 
 
-def convert_book_for_kindle(input_path: str, output_path: str, metadata: dict, cover_path: str = None) -> tuple[bool, str]:
+def available_memory():
+    """MemAvailable из /proc/meminfo в байтах; None, если узнать нельзя (не Linux)"""
+    try:
+        with open("/proc/meminfo", "rb") as f:
+            for line in f:
+                if line.startswith(b"MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+async def wait_for_memory(min_bytes: int) -> None:
+    """Ждёт свободной памяти с растущей паузой, но не дольше MEMORY_WAIT_LIMIT секунд"""
+    delay, waited = 1.0, 0.0
+    while waited < MEMORY_WAIT_LIMIT:
+        available = available_memory()
+        if available is None or available >= min_bytes:
+            return
+        logger.warning(f"Мало памяти ({available / 1024 / 1024:.0f} МБ), конвертация ждёт {delay:.0f} с")
+        await asyncio.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, 30)
+    logger.warning("Память так и не освободилась, запускаю конвертацию")
+
+
+async def run_ebook_convert(cmd: list[str], timeout: float) -> tuple[int, str, str]:
+    """ebook-convert в прогретом процессе Calibre, а без пула - отдельным запуском"""
+    async with convert_slots:
+        await wait_for_memory(MIN_FREE_MEMORY)
+        return await _run_ebook_convert(cmd, timeout)
+
+
+async def _run_ebook_convert(cmd: list[str], timeout: float) -> tuple[int, str, str]:
+    if calibre_pool is not None:
+        try:
+            return await calibre_pool.convert(cmd[1:], timeout)
+        except asyncio.TimeoutError:
+            # Книга сама по себе слишком долгая, второй запуск не поможет
+            raise
+        except Exception as e:
+            logger.warning(f"Пул Calibre не сработал, запускаю ebook-convert: {e}")
+    # Прогресс ebook-convert занимает мегабайты, а нужен только stderr
+    return await run_process([*LOW_PRIORITY, *cmd], timeout, capture_stdout=False)
+
+
+async def convert_book_for_kindle(input_path: str, output_path: str, metadata: dict, cover_path: str = None) -> tuple[bool, str]:
     """Конвертация книги с метаданными для Kindle"""
     try:
         cmd = ["ebook-convert", input_path, output_path]
@@ -259,18 +693,19 @@ def convert_book_for_kindle(input_path: str, output_path: str, metadata: dict, c
             cmd.extend(["--series-index", str(metadata["series_index"])])
         
         # Добавляем обложку если есть
-        if cover_path and Path(cover_path).exists() and Path(cover_path).stat().st_size > 1000:
+        cover_size = _size_or_zero(cover_path) if cover_path else 0
+        if cover_size > 1000:
             # Оптимизируем обложку для Kindle
-            optimize_cover_for_kindle(cover_path)
+            await asyncio.to_thread(optimize_cover_for_kindle, cover_path)
             
             cmd.extend(["--cover", cover_path])
-            logger.info(f"Конвертация с обложкой ({Path(cover_path).stat().st_size} байт)")
+            logger.info(f"Конвертация с обложкой (исходно {cover_size} байт)")
         else:
             cmd.append("--no-default-epub-cover")
             logger.info("Конвертация без обложки")
         
         # ОПЦИИ ДЛЯ МИНИАТЮРЫ В KINDLE
-        output_ext = Path(output_path).suffix.lower()
+        output_ext = os.path.splitext(output_path)[1].lower()
         
         if output_ext == ".mobi":
             # Критические опции для MOBI (старые Kindle)
@@ -292,343 +727,348 @@ def convert_book_for_kindle(input_path: str, output_path: str, metadata: dict, c
         # Общие опции для улучшения метаданных
         cmd.extend([
             "--metadata",                     # Явно указываем метаданные
-            "--smarten-punctuation",          # Улучшаем пунктуацию
             "--chapter", "//h:h1",            # Главы по h1
             "--chapter-mark", "pagebreak",    # Разрывы страниц для глав
             "--page-breaks-before", "//*[name()='h1' or name()='h2']",
         ])
+        if not FAST_CONVERSION:
+            cmd.append("--smarten-punctuation")  # Улучшаем пунктуацию
         
         logger.info(f"Выполняю: {' '.join(cmd[:10])}...")
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=300,
-            encoding='utf-8',
-            errors='replace'
-        )
+        returncode, stdout, stderr = await run_ebook_convert(cmd, timeout=300)
         
         # Логируем вывод для отладки
-        if result.stdout:
-            logger.debug(f"Stdout: {result.stdout[:200]}")
-        if result.stderr:
+        if stdout:
+            logger.debug(f"Stdout: {stdout[:200]}")
+        if stderr:
             # Фильтруем стандартные предупреждения
-            error_lines = [line for line in result.stderr.split('\n') 
-                          if line.strip() and not line.startswith("Usage:")]
+            error_lines = [line for line in stderr.split('\n') 
+                          if line.strip() and not line.startswith(STDERR_IGNORE_PREFIXES)]
             if error_lines:
                 logger.warning(f"Stderr: {error_lines[0][:200]}")
         
-        output_p = Path(output_path)
-        if result.returncode != 0 or not output_p.exists() or output_p.stat().st_size == 0:
-            error_msg = f"Код ошибки: {result.returncode}"
-            if result.stderr:
-                for line in result.stderr.split('\n'):
-                    if line.strip() and not line.startswith("Usage:"):
+        output_size = _size_or_zero(output_path)
+        if returncode != 0 or output_size == 0:
+            error_msg = f"Код ошибки: {returncode}"
+            if stderr:
+                for line in stderr.split('\n'):
+                    if line.strip() and not line.startswith(STDERR_IGNORE_PREFIXES):
                         error_msg = line.strip()[:200]
                         break
             return False, error_msg
         
-        # ПРОВЕРЯЕМ МЕТАДАННЫЕ В ВЫХОДНОМ ФАЙЛЕ
-        meta_check = ""
-        try:
-            check_result = subprocess.run(
-                ["ebook-meta", output_path],
-                capture_output=True,
-                text=True,
-                timeout=30
+        # Что именно встроено, известно по переданным опциям:
+        # повторно читать результат через ebook-meta незачем
+        meta_check = " | " + " | ".join(
+            f"{'✓' if ok else '✗'} {name}" for name, ok in (
+                ("название", _known(metadata.get("title"))),
+                ("автор", any(_known(a) for a in metadata.get("authors") or [])),
+                ("обложка", "--cover" in cmd),
             )
-            
-            # Ищем название и автора
-            has_title = False
-            has_author = False
-            has_cover = False
-            
-            for line in check_result.stdout.split('\n'):
-                line = line.strip()
-                if line.startswith("Title:"):
-                    val = line[6:].strip()
-                    if val and val.lower() != "unknown" and val:
-                        has_title = True
-                elif line.startswith("Author(s):"):
-                    val = line[10:].strip()
-                    if val and val.lower() != "unknown" and val:
-                        has_author = True
-                elif "Cover:" in line or "Has cover:" in line:
-                    if "yes" in line.lower() or "true" in line.lower():
-                        has_cover = True
-            
-            meta_check_parts = []
-            if has_title:
-                meta_check_parts.append("✓ название")
-            else:
-                meta_check_parts.append("✗ название")
-                
-            if has_author:
-                meta_check_parts.append("✓ автор")
-            else:
-                meta_check_parts.append("✗ автор")
-                
-            if has_cover:
-                meta_check_parts.append("✓ обложка")
-            else:
-                meta_check_parts.append("✗ обложка")
-            
-            meta_check = " | " + " | ".join(meta_check_parts)
-            
-        except Exception as e:
-            logger.debug(f"Не удалось проверить метаданные: {e}")
-            meta_check = ""
+        )
         
-        size_info = f"{output_p.stat().st_size / 1024 / 1024:.2f} МБ"
+        size_info = f"{output_size / 1024 / 1024:.2f} МБ"
         return True, f"{size_info}{meta_check}"
         
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         return False, "Таймаут конвертации"
     except Exception as e:
         logger.error(f"Ошибка конвертации: {e}", exc_info=True)
         return False, str(e)[:150]
 
 
-async def conversion_worker(application: Application):
-    logger.info("🔄 Воркер запущен")
+async def read_book(fb2_reader, path: str, cover_path: str) -> tuple[dict, bool]:
+    """Метаданные и обложка: из уже разобранного FB2, иначе одним вызовом Calibre"""
+    if fb2_reader is None or not fb2_reader.title:
+        return await extract_metadata_and_cover(path, cover_path)
+    metadata = fb2_reader.get_metadata()
+    if await asyncio.to_thread(fb2_reader.write_cover, cover_path):
+        logger.info(f"Обложка извлечена из FB2: {len(fb2_reader.cover_bytes)} байт")
+        return metadata, True
+    return metadata, await extract_fb2_cover(path, cover_path)
+
+
+async def download_task_file(bot, task: dict) -> bool:
+    """Скачивает и проверяет книгу задачи; при ошибке сообщает пользователю"""
+    try:
+        # Качаем потоком прямо в файл: в памяти один кусок, а хэш для кэша
+        # конвертаций считается по ходу, без повторного чтения с диска
+        file = await bot.get_file(task["file_id"])
+        hasher = hashlib.blake2b(digest_size=16)
+        size = 0
+        async with download_client.stream("GET", file.file_path) as response:
+            response.raise_for_status()
+            with open(task["input_path"], "wb") as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK):
+                    # Не ZIP и не FB2 отсекаем до Calibre, а не после минут
+                    # конвертации. ZIP под именем .fb2 пропускаем: его по
+                    # сигнатуре распакует unpack_if_needed
+                    if size == 0 and sniff_bytes(chunk[:64]) == "unknown":
+                        break
+                    # Запись куска в page cache быстрее, чем передача в поток
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+        
+        if size == 0:
+            logger.info(f"Файл не похож ни на ZIP, ни на FB2: {task['file_name']}")
+            await bot.send_message(
+                chat_id=task["user_id"],
+                text=UNSUPPORTED_FORMAT_TEXT,
+                reply_markup=MAIN_REPLY_KEYBOARD
+            )
+            return False
+        
+        # Заново загруженный с диска файл получает новый file_unique_id,
+        # поэтому ищем и по содержимому
+        task["content_key"] = f"b2:{hasher.hexdigest()}"
+        
+        logger.info(f"Файл принят: {task['file_name']} ({size / 1024 / 1024:.2f} МБ)")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Ошибка загрузки файла: {e}")
+        await bot.send_message(
+            chat_id=task["user_id"],
+            text="❌ Ошибка загрузки файла",
+            reply_markup=MAIN_REPLY_KEYBOARD
+        )
+        return False
+
+
+async def process_task(application: Application, task: dict):
+    """Конвертирует одну книгу из очереди и отправляет результат пользователю"""
+    active_tasks[task["task_id"]]["status"] = "converting"
     
-    while True:
+    if not await download_task_file(application.bot, task):
+        return
+    if await send_cached(application.bot, task["user_id"], task["content_key"], task["output_format"]):
+        return
+    
+    # Распаковываем если нужно
+    unpacked_path = await asyncio.to_thread(unpack_if_needed, task["input_path"])
+    
+    # FB2 читаем сами за один проход: и метаданные, и обложка
+    fb2_reader = None
+    if FB2Reader is not None and unpacked_path.lower().endswith(".fb2"):
         try:
-            task = await conversion_queue.get()
-            task_id = task["task_id"]
-            active_tasks[task_id]["status"] = "converting"
-            
-            # Распаковываем если нужно
-            unpacked_path = unpack_if_needed(task["input_path"])
-            cleanup_unpacked = (unpacked_path != task["input_path"])
-            
-            # Извлекаем метаданные
-            metadata = extract_metadata(unpacked_path)
-            title = metadata["title"] or "Без названия"
-            author = metadata["authors"][0] if metadata["authors"] else "Неизвестен"
-            
-            # Извлекаем обложку
-            cover_path = f"{task['input_path']}.cover.jpg"
-            has_cover = extract_cover(unpacked_path, cover_path)
-            
-            # Обновляем статус
-            try:
-                status = f"⏳ Конвертирую:\n<b>{title}</b>\n<i>{author}</i>"
-                if has_cover:
-                    cover_size = Path(cover_path).stat().st_size if Path(cover_path).exists() else 0
-                    status += f"\n✅ Обложка найдена ({cover_size/1024:.1f} КБ)"
-                    status += f"\n🔧 Оптимизирую для Kindle..."
-                else:
-                    status += "\n⚠️ Обложка не найдена"
-                
-                await application.bot.edit_message_text(
-                    chat_id=task["user_id"],
-                    message_id=task["message_id"],
-                    text=status,
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                logger.warning(f"Не удалось обновить статус: {e}")
+            fb2_reader = await asyncio.to_thread(FB2Reader, unpacked_path)
+        except Exception as e:
+            logger.info(f"FB2 не разобран как XML, использую ebook-meta: {e}")
+    
+    # Извлекаем метаданные и обложку
+    cover_path = os.path.join(task["task_dir"], "cover.jpg")
+    metadata, has_cover = await read_book(fb2_reader, unpacked_path, cover_path)
+    title = metadata["title"] or "Без названия"
+    author = metadata["authors"][0] if metadata["authors"] else "Неизвестен"
+    
+    # Обновляем статус, только если книга ждала в очереди: иначе пользователь
+    # только что видел сообщение о постановке, и лишний запрос к Telegram не нужен
+    waited = task["started_at"] - task["queued_at"]
+    if waited > STATUS_EDIT_MIN_WAIT and "message_id" in task:
+        try:
+            status = f"⏳ Конвертирую:\n<b>{title}</b>\n<i>{author}</i>"
+            if has_cover:
+                cover_size = _size_or_zero(cover_path)
+                status += f"\n✅ Обложка найдена ({cover_size/1024:.1f} КБ)"
+                status += f"\n🔧 Оптимизирую для Kindle..."
+            else:
+                status += "\n⚠️ Обложка не найдена"
             
-            # Конвертируем с улучшенной функцией
-            success, diag = convert_book_for_kindle(
-                unpacked_path,
-                task["output_path"],
-                metadata,
-                cover_path if has_cover else None
+            await application.bot.edit_message_text(
+                chat_id=task["user_id"],
+                message_id=task["message_id"],
+                text=status,
+                parse_mode=ParseMode.HTML
             )
-            
-            # Отправляем результат
-            output_p = Path(task["output_path"])
-            if success and output_p.exists():
-                safe_title = re.sub(r'[<>:"/\\|?*]', '', title)[:50]
-                safe_author = re.sub(r'[<>:"/\\|?*]', '', author)[:30]
-                filename = f"{safe_author} - {safe_title}{output_p.suffix}"
-                
-                caption = f"✅ Конвертация завершена\n📚 {title}\n👤 {author}\n💾 {diag}"
-                
-                # Дополнительная информация о миниатюрах
-                extra_info = ""
-                if task["output_format"] == "mobi":
-                    extra_info = (
-                        "\n\n📱 <b>Для отображения миниатюры на Kindle:</b>\n"
-                        "1. Отправьте файл на email Kindle\n"
-                        "2. В теме письма добавьте <code>convert</code>\n"
-                        "3. Или используйте Calibre для копирования"
-                    )
-                elif task["output_format"] == "azw3":
-                    extra_info = (
-                        "\n\n📱 <b>Для лучшего отображения:</b>\n"
-                        "• Используйте кабель USB\n"
-                        "• Или отправьте через email"
-                    )
-                
-                await application.bot.send_document(
-                    chat_id=task["user_id"],
-                    document=open(output_p, "rb"),
-                    filename=filename,
-                    caption=caption,
-                    parse_mode=ParseMode.HTML,
-                )
-                
-                if extra_info:
-                    await application.bot.send_message(
-                        chat_id=task["user_id"],
-                        text=extra_info,
-                        parse_mode=ParseMode.HTML
-                    )
-                
-                await application.bot.send_message(
-                    chat_id=task["user_id"],
-                    text="Файл готов для Kindle! 📚",
-                    reply_markup=MAIN_REPLY_KEYBOARD
-                )
-            else:
-                error_msg = (
-                    f"❌ Ошибка конвертации <b>{title}</b>:\n"
-                    f"<code>{diag}</code>\n\n"
-                    f"<b>Попробуйте:</b>\n"
-                    f"1. Использовать формат AZW3 вместо MOBI\n"
-                    f"2. Отправить книгу заново\n"
-                    f"3. Проверить исходный файл"
-                )
-                await application.bot.send_message(
-                    chat_id=task["user_id"],
-                    text=error_msg,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=MAIN_REPLY_KEYBOARD
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус: {e}")
+    
+    # Конвертируем с улучшенной функцией
+    success, diag = await convert_book_for_kindle(
+        unpacked_path,
+        task["output_path"],
+        metadata,
+        cover_path if has_cover else None
+    )
+    
+    # Отправляем результат
+    output_p = Path(task["output_path"])
+    if success:
+        safe_title = title.translate(UNSAFE_FILENAME_CHARS)[:50]
+        safe_author = author.translate(UNSAFE_FILENAME_CHARS)[:30]
+        filename = f"{safe_author} - {safe_title}{output_p.suffix}"
+        
+        caption = f"✅ Конвертация завершена\n📚 {title}\n👤 {author}\n💾 {diag}"
+        
+        # Дополнительная информация о миниатюрах
+        extra_info = ""
+        if task["output_format"] == "mobi":
+            extra_info = (
+                "\n\n📱 <b>Для отображения миниатюры на Kindle:</b>\n"
+                "1. Отправьте файл на email Kindle\n"
+                "2. В теме письма добавьте <code>convert</code>\n"
+                "3. Или используйте Calibre для копирования"
+            )
+        elif task["output_format"] == "azw3":
+            extra_info = (
+                "\n\n📱 <b>Для лучшего отображения:</b>\n"
+                "• Используйте кабель USB\n"
+                "• Или отправьте через email"
+            )
+        
+        # Всё помещается в подпись - обходимся одним запросом к Telegram
+        full_caption = f"{caption}{extra_info}\n\n{READY_TEXT}"
+        followup = None
+        if len(full_caption) > CAPTION_LIMIT:
+            full_caption = caption
+            followup = f"{extra_info}\n\n{READY_TEXT}".lstrip()
+        
+        # Книгу в память целиком не читаем: с read_file_handle=False httpx
+        # отправляет файл кусками по 64 КБ прямо из открытого дескриптора
+        with open(output_p, "rb") as book_file:
+            sent = await application.bot.send_document(
+                chat_id=task["user_id"],
+                document=InputFile(book_file, filename=filename, read_file_handle=False),
+                caption=full_caption,
+                parse_mode=ParseMode.HTML,
+                reply_markup=None if followup else MAIN_REPLY_KEYBOARD
+            )
+        if sent.document:
+            for book_key in (task["file_unique_id"], task["content_key"]):
+                settings_db.save_converted(
+                    book_key, task["output_format"], sent.document.file_id, full_caption
                 )
-            
-            # Чистим файлы
-            cleanup_files = [
-                task["input_path"],
-                task["output_path"],
-                cover_path,
-                f"{task['input_path']}.cover.jpg",
-                f"{unpacked_path}.cover.jpg"
-            ]
-            
-            for p in cleanup_files:
-                try:
-                    fp = Path(p)
-                    if fp.exists():
-                        fp.unlink()
-                except:
-                    pass
-            
-            if cleanup_unpacked:
-                try:
-                    Path(unpacked_path).unlink()
-                except:
-                    pass
-            
-            conversion_queue.task_done()
-            active_tasks.pop(task_id, None)
-            
+        
+        if followup:
+            await application.bot.send_message(
+                chat_id=task["user_id"],
+                text=followup,
+                parse_mode=ParseMode.HTML,
+                reply_markup=MAIN_REPLY_KEYBOARD
+            )
+    else:
+        error_msg = (
+            f"❌ Ошибка конвертации <b>{title}</b>:\n"
+            f"<code>{diag}</code>\n\n"
+            f"<b>Попробуйте:</b>\n"
+            f"1. Использовать формат AZW3 вместо MOBI\n"
+            f"2. Отправить книгу заново\n"
+            f"3. Проверить исходный файл"
+        )
+        await application.bot.send_message(
+            chat_id=task["user_id"],
+            text=error_msg,
+            parse_mode=ParseMode.HTML,
+            reply_markup=MAIN_REPLY_KEYBOARD
+        )
+
+
+def queued_books() -> int:
+    """Книги, ожидающие конвертации: в общей очереди и в очередях пользователей"""
+    return conversion_queue.qsize() + sum(len(b) for b in user_backlogs.values())
+
+
+def task_priority(task: dict) -> float:
+    size_delay = task["file_size"] / (1024 * 1024) * SIZE_DELAY_PER_MB
+    return task["queued_at"] + min(size_delay, MAX_SIZE_DELAY)
+
+
+def enqueue_task(task: dict) -> None:
+    conversion_queue.put_nowait((task_priority(task), next(queue_counter), task))
+
+
+def submit_task(task: dict) -> None:
+    """Ставит книгу в очередь; пока предыдущая книга пользователя не готова, ждёт за ней"""
+    backlog = user_backlogs.get(task["user_id"])
+    if backlog is None:
+        user_backlogs[task["user_id"]] = deque()
+        enqueue_task(task)
+    else:
+        backlog.append(task)
+
+
+def release_user(user_id: int) -> None:
+    """Книга пользователя готова: ставим в очередь его следующую или забываем его"""
+    backlog = user_backlogs.get(user_id)
+    if backlog:
+        enqueue_task(backlog.popleft())
+    else:
+        user_backlogs.pop(user_id, None)
+
+
+async def conversion_worker(application: Application, worker_id: int = 0):
+    logger.info(f"🔄 Воркер {worker_id} запущен")
+    
+    while True:
+        _, _, task = await conversion_queue.get()
+        task["started_at"] = time.monotonic()
+        try:
+            await process_task(application, task)
         except Exception as e:
             logger.error(f"Ошибка воркера: {e}", exc_info=True)
             await asyncio.sleep(5)
+        finally:
+            # Упавшая задача не должна оставаться в active_tasks и на диске:
+            # все её файлы лежат в одном каталоге
+            await asyncio.to_thread(shutil.rmtree, task["task_dir"], ignore_errors=True)
+            active_tasks.pop(task["task_id"], None)
+            release_user(task["user_id"])
+            conversion_queue.task_done()
+
+
+async def supervise_worker(application: Application, worker_id: int = 0):
+    """Перезапускает воркер, если он упал с необработанным исключением"""
+    while True:
+        try:
+            await conversion_worker(application, worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Воркер {worker_id} упал, перезапуск: {e}", exc_info=True)
+            await asyncio.sleep(1)
 
 
+@allowlisted
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
-        "📚 <b>KindleGarden Bot v3</b>\n\n"
-        "<b>Улучшенная конвертация с метаданными!</b>\n\n"
-        "✅ <b>Что нового:</b>\n"
-        "• Правильное заполнение названия и автора\n"
-        "• Оптимизация обложек для Kindle\n"
-        "• Лучшая поддержка миниатюр\n\n"
-        "<b>Форматы:</b>\n"
-        "• FB2 / FB2.ZIP\n"
-        "• EPUB\n\n"
-        "<b>Совет:</b> Используйте AZW3 для новых Kindle\n"
-        "для гарантированного отображения обложек.",
+        START_TEXT,
         parse_mode=ParseMode.HTML,
         reply_markup=MAIN_REPLY_KEYBOARD
     )
 
 
+@allowlisted
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    message = (
-        "📚 <b>KindleGarden - помощь</b>\n\n"
-        
-        "✅ <b>Как работают метаданные и обложки:</b>\n"
-        "1. Бот извлекает название, автора и обложку\n"
-        "2. Оптимизирует обложку для Kindle (800x1200)\n"
-        "3. Встраивает метаданные в книгу\n"
-        "4. Использует специальные настройки для миниатюр\n\n"
-        
-        "🖼️ <b>Почему миниатюра может не отображаться:</b>\n"
-        "• <b>MOBI</b>: Требуется отправка через email с темой 'convert'\n"
-        "• <b>AZW3</b>: Обычно работает через USB\n"
-        "• Размер обложки менее 600x800 пикселей\n"
-        "• Старый Kindle (до 5 поколения)\n\n"
-        
-        "⚙️ <b>Рекомендации по форматам:</b>\n"
-        "• <b>AZW3</b> - лучшая поддержка, новые Kindle\n"
-        "• <b>MOBI</b> - старые Kindle, отправка через email\n"
-        "• <b>EPUB</b> - другие устройства\n\n"
-        
-        "📧 <b>Для MOBI миниатюр:</b>\n"
-        "Отправьте файл на email Kindle\n"
-        "Тема письма: <code>convert</code>\n"
-        "Или используйте Calibre\n\n"
-        
-        "⏱️ <b>Ограничения:</b>\n"
-        "• Размер: до 50 МБ\n"
-        "• Время: до 5 минут\n"
-        "• Очередь: 5 файлов"
-    )
     await update.message.reply_text(
-        message,
+        HELP_TEXT,
         parse_mode=ParseMode.HTML,
         reply_markup=MAIN_REPLY_KEYBOARD
     )
 
 
+@allowlisted
 async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     current = settings_db.get_preferred_format(user_id)
     
-    # Описание форматов с советами по миниатюрам
-    formats_info = {
-        "azw3": "📘 AZW3 - лучшие миниатюры (USB, новые Kindle)",
-        "mobi": "📙 MOBI - совместимость (email, старые Kindle)",
-        "epub": "📖 EPUB - другие читалки"
-    }
-    
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(
-            f"{'✅ ' if fmt == current else ''}{desc}", 
-            callback_data=f"setfmt:{fmt}"
-        )] for fmt, desc in formats_info.items()
-    ])
-    
     await update.message.reply_text(
-        f"⚙️ <b>Текущий формат:</b> {current.upper()}\n\n"
-        f"<b>Советы по миниатюрам:</b>\n"
-        f"• AZW3 - миниатюры через USB\n"
-        f"• MOBI - миниатюры через email\n"
-        f"• EPUB - без гарантий для Kindle",
+        f"⚙️ <b>Текущий формат:</b> {current.upper()}\n\n{SETTINGS_TIPS_TEXT}",
         parse_mode=ParseMode.HTML,
-        reply_markup=kb
+        reply_markup=SETTINGS_KEYBOARDS.get(current, SETTINGS_KEYBOARDS["azw3"])
     )
 
 
+@allowlisted
 async def handle_format_setting(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    _, fmt = query.data.split(":")
+    fmt = FORMAT_CALLBACKS[query.data]
     
     settings_db.set_preferred_format(update.effective_user.id, fmt)
     
-    # Совет в зависимости от формата
-    advice = {
-        "mobi": "\n\n⚠️ <b>Для миниатюр MOBI:</b>\nОтправляйте файлы на email Kindle\nс темой 'convert'",
-        "azw3": "\n\n✅ <b>Для миниатюр AZW3:</b>\nИспользуйте USB кабель\nили Calibre для копирования",
-        "epub": "\n\n📖 <b>Для EPUB:</b>\nФормат для других устройств,\nне гарантирует миниатюры на Kindle"
-    }.get(fmt, "")
+    advice = FORMAT_ADVICE.get(fmt, "")
     
     await query.edit_message_text(
         f"✅ Формат изменен на <b>{fmt.upper()}</b>{advice}",
@@ -640,18 +1080,37 @@ async def handle_format_setting(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
 
+async def send_cached(bot, chat_id: int, book_key: str, output_format: str) -> bool:
+    """Пересылает уже сконвертированную книгу по file_id; False, если её нет в кэше"""
+    cached = settings_db.get_converted(book_key, output_format)
+    if not cached:
+        return False
+    file_id, caption = cached
+    try:
+        await bot.send_document(
+            chat_id=chat_id,
+            document=file_id,
+            caption=caption,
+            parse_mode=ParseMode.HTML,
+            reply_markup=MAIN_REPLY_KEYBOARD
+        )
+    except TelegramError as e:
+        logger.warning(f"Кэшированный файл недоступен, конвертирую заново: {e}")
+        settings_db.forget_converted(book_key, output_format)
+        return False
+    logger.info(f"Отправлено из кэша: {book_key} ({output_format})")
+    return True
+
+
+@allowlisted
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     doc = update.message.document
     fname = doc.file_name.lower() if doc.file_name else ""
     
     # Проверяем формат
-    supported_formats = ['.fb2', '.fb2.zip', '.epub']
-    if not any(fname.endswith(fmt) for fmt in supported_formats):
+    if not fname.endswith(SUPPORTED_EXTS):
         await update.message.reply_text(
-            "⚠️ Поддерживаются только:\n"
-            "• FB2 (.fb2)\n"
-            "• FB2.ZIP (.fb2.zip)\n"
-            "• EPUB (.epub)",
+            UNSUPPORTED_FORMAT_TEXT,
             reply_markup=MAIN_REPLY_KEYBOARD
         )
         return
@@ -659,117 +1118,182 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Проверяем размер
     if doc.file_size > 50 * 1024 * 1024:
         await update.message.reply_text(
-            "⚠️ Максимальный размер файла - 50 МБ",
+            TOO_LARGE_TEXT,
             reply_markup=MAIN_REPLY_KEYBOARD
         )
         return
 
-    if conversion_queue.full():
+    output_format = settings_db.get_preferred_format(update.effective_user.id)
+    
+    # EPUB в EPUB: возвращаем тот же файл по file_id, без скачивания и Calibre
+    if output_format == "epub" and fname.endswith(".epub"):
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=doc.file_id,
+            caption=ALREADY_IN_FORMAT_TEXT,
+            reply_markup=MAIN_REPLY_KEYBOARD
+        )
+        return
+    
+    # Эту книгу в этом формате уже конвертировали: пересылаем готовый файл
+    # по file_id, без скачивания, конвертации и повторной загрузки
+    if await send_cached(context.bot, update.effective_chat.id, doc.file_unique_id, output_format):
+        return
+
+    if queued_books() >= QUEUE_SIZE:
         await update.message.reply_text(
-            f"⏸️ Очередь заполнена ({conversion_queue.qsize()}/5)\nПожалуйста, подождите...",
+            f"⏸️ Очередь заполнена ({queued_books()}/{QUEUE_SIZE})\nПожалуйста, подождите...",
             reply_markup=MAIN_REPLY_KEYBOARD
         )
         return
 
-    base_tmp = Path.cwd() / "tmp"
-    simple_id = str(uuid4()).replace("-", "")[:12]
-    input_ext = Path(fname).suffix or ".fb2"
-    output_ext = f".{settings_db.get_preferred_format(update.effective_user.id)}"
+    simple_id = uuid4().hex[:12]
+    input_ext = os.path.splitext(fname)[1] or ".fb2"
+    output_ext = f".{output_format}"
     
-    input_path = base_tmp / f"in_{simple_id}{input_ext}"
-    output_path = base_tmp / f"out_{simple_id}{output_ext}"
+    # Исходник, распакованный FB2, обложка и результат - в своём каталоге задачи
+    task_dir = tempfile.mkdtemp(dir=TMP_DIR, prefix=f"task_{simple_id}_")
+    input_path = os.path.join(task_dir, f"in{input_ext}")
+    output_path = os.path.join(task_dir, f"out{output_ext}")
     
     task = {
         "task_id": simple_id,
         "user_id": update.effective_user.id,
         "file_id": doc.file_id,
+        "file_unique_id": doc.file_unique_id,
         "file_name": doc.file_name,
-        "input_path": str(input_path),
-        "output_path": str(output_path),
+        "task_dir": task_dir,
+        "input_path": input_path,
+        "output_path": output_path,
         "output_format": output_ext[1:],
+        "file_size": doc.file_size or 0,
         "status": "queued",
     }
     active_tasks[simple_id] = task
 
-    try:
-        file = await context.bot.get_file(doc.file_id)
-        await file.download_to_drive(task["input_path"])
-        
-        input_size = Path(task["input_path"]).stat().st_size
-        if input_size == 0:
-            raise ValueError("Пустой файл")
-        
-        logger.info(f"Файл принят: {doc.file_name} ({input_size / 1024 / 1024:.2f} МБ)")
-        
-    except Exception as e:
-        logger.error(f"Ошибка загрузки файла: {e}")
-        await update.message.reply_text(
-            f"❌ Ошибка загрузки файла",
-            reply_markup=MAIN_REPLY_KEYBOARD
-        )
-        try:
-            Path(task["input_path"]).unlink(missing_ok=True)
-        except:
-            pass
-        return
-
-    await conversion_queue.put(task)
-    
-    format_advice = {
-        "azw3": "AZW3 (миниатюры через USB)",
-        "mobi": "MOBI (миниатюры через email)",
-        "epub": "EPUB (другие устройства)"
-    }
+    # Скачивает уже воркер: обработчик сразу отвечает и не держит
+    # остальные обновления, пока файл идёт по сети
+    task["queued_at"] = time.monotonic()
+    submit_task(task)
     
     msg = await update.message.reply_text(
-        f"✅ Добавлено в очередь ({conversion_queue.qsize()}/5)\n"
+        f"✅ Добавлено в очередь ({queued_books()}/{QUEUE_SIZE})\n"
         f"Формат: <b>{task['output_format'].upper()}</b>\n"
-        f"{format_advice.get(task['output_format'], '')}\n\n"
+        f"{QUEUED_FORMAT_ADVICE.get(task['output_format'], '')}\n\n"
         f"⏳ Извлекаю метаданные и обложку...",
         parse_mode=ParseMode.HTML
     )
     task["message_id"] = msg.message_id
 
 
+@allowlisted
+async def send_book_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(
+        SEND_BOOK_TEXT,
+        parse_mode=ParseMode.HTML,
+        reply_markup=MAIN_REPLY_KEYBOARD
+    )
+
+
+@allowlisted
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    t = update.message.text.strip()
-    if t == "📚 Отправить книгу":
-        await update.message.reply_text(
-            "📎 Отправьте FB2 или EPUB файл\n"
-            "Максимальный размер: 50 МБ\n\n"
-            "✅ <b>Новые возможности:</b>\n"
-            "• Заполнение названия и автора\n"
-            "• Оптимизация обложек\n"
-            "• Лучшие миниатюры для Kindle",
-            parse_mode=ParseMode.HTML,
-            reply_markup=MAIN_REPLY_KEYBOARD
-        )
-    elif t == "⚙️ Настройки":
-        await settings_menu(update, context)
-    elif t == "❓ Помощь":
-        await help_command(update, context)
-    else:
-        await update.message.reply_text(
-            "Используйте меню ниже 👇",
-            reply_markup=MAIN_REPLY_KEYBOARD
+    """Любой текст вне меню (кнопки меню обрабатываются своими фильтрами)"""
+    await update.message.reply_text(FALLBACK_TEXT, reply_markup=MAIN_REPLY_KEYBOARD)
+
+
+def sweep_tmp_dir() -> int:
+    """Удаляет каталоги задач, оставшиеся после падения; возвращает их число"""
+    removed = 0
+    with os.scandir(TMP_DIR) as entries:
+        for entry in entries:
+            # В KG_TMP_DIR могут лежать чужие файлы: трогаем только свои каталоги
+            if entry.name.startswith("task_") and entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    return removed
+
+
+def _has_tool(name: str) -> bool:
+    """Проверяет, что утилита есть в PATH и исполняема (без запуска процесса)"""
+    path = shutil.which(name)
+    return path is not None and os.access(path, os.X_OK)
+
+
+CALIBRE_STAMP = Path("data/calibre_version")
+
+
+def probe_calibre_version() -> str:
+    """Возвращает версию Calibre; ebook-convert запускается только после обновления"""
+    exe = shutil.which("ebook-convert")
+    key = f"{exe}:{os.stat(exe).st_mtime}"
+    try:
+        cached_key, cached_version = CALIBRE_STAMP.read_text(encoding="utf-8").split("\n", 1)
+        if cached_key == key:
+            return cached_version.strip()
+    except (OSError, ValueError):
+        pass
+    
+    try:
+        result = subprocess.run(
+            [exe, "--version"],
+            capture_output=True,
+            text=True,
+            timeout=10
         )
+    except (FileNotFoundError, PermissionError) as e:
+        logger.error(f"❌ ebook-convert не запускается: {e}")
+        raise RuntimeError("ebook-convert не запускается. Установите Calibre: sudo apt install calibre")
+    except subprocess.TimeoutExpired:
+        logger.error("❌ ebook-convert не ответил за 10 секунд")
+        raise RuntimeError("ebook-convert установлен, но не отвечает. Проверьте установку Calibre")
+    if result.returncode != 0:
+        logger.error("❌ ebook-convert не работает")
+        raise RuntimeError("ebook-convert не работает. Установите Calibre: sudo apt install calibre")
+    
+    version = result.stdout.strip().splitlines()[0] if result.stdout.strip() else "?"
+    try:
+        CALIBRE_STAMP.write_text(f"{key}\n{version}\n", encoding="utf-8")
+    except OSError as e:
+        logger.debug(f"Не удалось сохранить версию Calibre: {e}")
+    return version
 
 
 async def post_init(app: Application) -> None:
     """Проверяем наличие необходимых инструментов"""
-    required_tools = ["ebook-convert", "ebook-meta"]
-    
-    for tool in required_tools:
-        try:
-            result = subprocess.run([tool, "--version"], capture_output=True, timeout=5)
-            if result.returncode == 0:
-                logger.info(f"✅ {tool} доступен")
-            else:
-                logger.error(f"❌ {tool} не работает")
-                raise RuntimeError(f"{tool} не работает. Установите Calibre: sudo apt install calibre")
-        except Exception as e:
-            logger.error(f"❌ {tool} не найден: {e}")
+    for tool in ("ebook-convert", "ebook-meta"):
+        if not _has_tool(tool):
+            logger.error(f"❌ {tool} не найден")
             raise RuntimeError(f"{tool} не найден. Установите Calibre: sudo apt install calibre")
+        logger.info(f"✅ {tool} доступен")
+
+    # Распаковка, Pillow и удаление файлов идут в потоках: ограничиваем их число,
+    # чтобы несколько воркеров не плодили потоки на слабом железе
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=4, thread_name_prefix="kg-io")
+    )
+    
+    swept = await asyncio.to_thread(sweep_tmp_dir)
+    if swept:
+        logger.info(f"Удалено {swept} временных каталогов от прошлого запуска")
+    
+    # Холодный старт Calibre долгий, поэтому не блокируем event loop
+    version = await asyncio.to_thread(probe_calibre_version)
+    logger.info(f"Версия Calibre: {version}")
+    
+    global calibre_get_metadata
+    calibre_get_metadata = await asyncio.to_thread(load_calibre_metadata_api)
+    if calibre_get_metadata is not None:
+        logger.info("✅ Метаданные читаются через API Calibre")
+    
+    # Прогретые процессы Calibre не тратят секунды на импорт при каждой книге.
+    # Пока пул не проверен на разных версиях Calibre, он включается явно
+    global calibre_pool
+    if os.getenv("CALIBRE_POOL", "0") == "1" and _has_tool("calibre-debug"):
+        calibre_pool = CalibrePool(CONVERSION_WORKERS)
+        logger.info(f"✅ Пул Calibre: {CONVERSION_WORKERS} процесс(ов)")
+    
+    global download_client
+    download_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0))
     
     # Проверяем наличие Pillow (PIL)
     try:
@@ -779,33 +1303,82 @@ async def post_init(app: Application) -> None:
         logger.warning("❌ Pillow не установлен. Обложки не будут оптимизированы.")
         logger.info("Установите: pip install Pillow")
     
-    asyncio.create_task(conversion_worker(app))
+    # Держим ссылки на задачи, иначе их может собрать GC.
+    # Воркеров на один больше, чем слотов конвертации (см. convert_slots)
+    app.bot_data["workers"] = [
+        asyncio.create_task(supervise_worker(app, i))
+        for i in range(CONVERSION_WORKERS + 1)
+    ]
     logger.info("✅ Бот готов к работе с улучшенной конвертацией")
 
 
+async def post_shutdown(app: Application) -> None:
+    """Останавливаем воркеры, процессы Calibre и закрываем БД при штатной остановке"""
+    workers = app.bot_data.pop("workers", [])
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    if calibre_pool is not None:
+        await calibre_pool.close()
+    if download_client is not None:
+        await download_client.aclose()
+    settings_db.close()
+    logger.info("Бот остановлен")
+
+
 def main() -> None:
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN не найден в .env файле")
     
-    app = Application.builder().token(token).post_init(post_init).build()
+    # uvloop быстрее стандартного цикла (только Linux/macOS)
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("✅ uvloop включён")
+    except ImportError:
+        pass
+    
+    # HTTP/2 мультиплексирует запросы всех воркеров в одно TLS-соединение
+    try:
+        import h2  # noqa: F401
+        http_version = "2"
+    except ImportError:
+        http_version = "1.1"
+    
+    builder = (
+        Application.builder()
+        .token(token)
+        .http_version(http_version)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # Ограничитель держит исходящие запросы в лимитах Telegram (30/с на бота,
+    # 20/мин на группу), чтобы готовые книги не упирались в 429 и ретраи
+    try:
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=2))
+    except RuntimeError:
+        logger.info("aiolimiter не установлен, исходящие запросы без ограничителя")
+    app = builder.build()
     
     # Добавляем обработчики
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("settings", settings_menu))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    app.add_handler(MessageHandler(filters.Text([BTN_SEND_BOOK]), send_book_prompt))
+    app.add_handler(MessageHandler(filters.Text([BTN_SETTINGS]), settings_menu))
+    app.add_handler(MessageHandler(filters.Text([BTN_HELP]), help_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    app.add_handler(CallbackQueryHandler(handle_format_setting, pattern="^setfmt:"))
+    app.add_handler(CallbackQueryHandler(handle_format_setting, pattern=FORMAT_CALLBACKS.__contains__))
     
     logger.info("🚀 Бот запущен с поддержкой метаданных и оптимизированных обложек")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Получаем только те типы обновлений, для которых есть обработчики
+    app.run_polling(allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY])
 
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        logger.info("Бот остановлен")
-    finally:
-        settings_db.close()
\ No newline at end of file
+        logger.info("Бот остановлен")
\ No newline at end of file
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+import shutil
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = Path(__file__).with_name("calibre_worker.py")
+# Процесс Calibre со временем копит память, поэтому периодически перезапускаем его
+MAX_JOBS_PER_PROCESS = 50
+
+
+def low_priority_prefix() -> list[str]:
+    """nice/ionice перед командой, чтобы конвертация не отнимала CPU и диск у бота"""
+    prefix = []
+    if shutil.which("nice"):
+        prefix += ["nice", "-n", "10"]
+    if shutil.which("ionice"):
+        prefix += ["ionice", "-c", "3"]
+    return prefix
+
+
+# Без nice/ionice (Windows) список пуст и команда запускается как есть
+LOW_PRIORITY = low_priority_prefix()
+
+
+class CalibreProcess:
+    """Долгоживущий calibre-debug, который конвертирует книги по одной"""
+
+    def __init__(self):
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.jobs = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            *LOW_PRIORITY, "calibre-debug", "-e", str(WORKER_SCRIPT),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=1024 * 1024
+        )
+        self.jobs = 0
+        logger.info(f"Запущен процесс Calibre (pid {self.proc.pid})")
+
+    async def stop(self):
+        if not self.alive:
+            return
+        self.proc.kill()
+        await self.proc.wait()
+
+    async def convert(self, args: list[str], timeout: float) -> tuple[int, str, str]:
+        """Те же аргументы, что у ebook-convert; возвращает (код, stdout, stderr)"""
+        if not self.alive or self.jobs >= MAX_JOBS_PER_PROCESS:
+            await self.stop()
+            await self.start()
+
+        try:
+            self.proc.stdin.write(json.dumps(args).encode() + b"\n")
+            await self.proc.stdin.drain()
+            line = await asyncio.wait_for(self.proc.stdout.readline(), timeout=timeout)
+        except BaseException:
+            # Таймаут, отмена или сломанный pipe: состояние процесса неизвестно
+            await self.stop()
+            raise
+        if not line:
+            await self.stop()
+            raise RuntimeError("Процесс Calibre неожиданно завершился")
+
+        self.jobs += 1
+        reply = json.loads(line)
+        return reply["rc"], reply["stdout"], reply["stderr"]
+
+
+class CalibrePool:
+    """Пул процессов Calibre: импорт плагинов оплачивается один раз, а не на каждую книгу"""
+
+    def __init__(self, size: int):
+        self._idle: asyncio.Queue[CalibreProcess] = asyncio.Queue()
+        self._all = [CalibreProcess() for _ in range(size)]
+        for p in self._all:
+            self._idle.put_nowait(p)
+
+    async def convert(self, args: list[str], timeout: float) -> tuple[int, str, str]:
+        process = await self._idle.get()
+        try:
+            return await process.convert(args, timeout)
+        finally:
+            self._idle.put_nowait(process)
+
+    async def close(self):
+        await asyncio.gather(*(p.stop() for p in self._all))
@@ -0,0 +1,52 @@
+"""Запускается через calibre-debug -e: конвертирует книги по запросам из stdin.
+
+Каждая строка stdin - JSON-список аргументов ebook-convert, на каждую
+отвечаем одной строкой JSON {"rc", "stdout", "stderr"} в stdout.
+"""
+import io
+import json
+import os
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+# Хвост stdout и начало stderr - больше боту для диагностики не нужно
+STDOUT_TAIL = 2000
+STDERR_HEAD = 16000
+
+
+def main():
+    # Ответы пишем в копию stdout, а всё, что Calibre выводит в fd 1 напрямую,
+    # уходит в stderr и не ломает протокол
+    proto = os.fdopen(os.dup(1), "w", encoding="utf-8", buffering=1)
+    os.dup2(2, 1)
+
+    # Тяжёлый импорт делается один раз на процесс, а не на каждую книгу
+    from calibre.ebooks.conversion.cli import main as ebook_convert
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        args = json.loads(line)
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                rc = ebook_convert(["ebook-convert", *args]) or 0
+            except SystemExit as e:
+                # sys.exit() без аргумента - это успех, как и у процесса
+                if e.code is None:
+                    rc = 0
+                else:
+                    rc = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                rc = 1
+        proto.write(json.dumps({
+            "rc": rc,
+            "stdout": out.getvalue()[-STDOUT_TAIL:],
+            "stderr": err.getvalue()[:STDERR_HEAD],
+        }) + "\n")
+
+
+if __name__ == "__main__":
+    main()
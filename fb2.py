@@ -0,0 +1,100 @@
+from typing import Optional
+
+from lxml import etree
+
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+
+class FB2Reader:
+    """Читает FB2 за один потоковый проход: метаданные из <title-info> и обложку"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.title: Optional[str] = None
+        self.authors: list[str] = []
+        self.series: Optional[str] = None
+        self.series_index: Optional[str] = None
+        self.cover_bytes: Optional[bytes] = None
+        self._parse()
+
+    def _parse(self):
+        cover_id = None
+        events = etree.iterparse(
+            self.path,
+            events=("end",),
+            tag=("{*}title-info", "{*}body", "{*}binary"),
+            huge_tree=True,
+        )
+        for _, elem in events:
+            name = etree.QName(elem).localname
+            if name == "title-info":
+                cover_id = self._read_title_info(elem)
+                if cover_id is None:
+                    # <description> идёт до текста и картинок: обложки не будет
+                    break
+            elif name == "binary" and elem.get("id") == cover_id:
+                self.cover_bytes = base64.b64decode(elem.text or "")
+                break
+            # Текст книги и остальные картинки в памяти не держим
+            elem.clear()
+
+    def _read_title_info(self, info) -> Optional[str]:
+        """Заполняет метаданные, возвращает id картинки обложки"""
+        self.title = _text(info.find("{*}book-title"))
+
+        for author in info.findall("{*}author"):
+            parts = [_text(author.find(f"{{*}}{tag}")) for tag in ("first-name", "last-name")]
+            name = " ".join(p for p in parts if p) or _text(author.find("{*}nickname"))
+            if name:
+                self.authors.append(name)
+
+        sequence = info.find("{*}sequence")
+        if sequence is not None and sequence.get("name"):
+            self.series = sequence.get("name").strip()
+            self.series_index = sequence.get("number")
+
+        image = info.find("{*}coverpage/{*}image")
+        if image is None:
+            return None
+        return (image.get(XLINK_HREF) or "").lstrip("#") or None
+
+    def get_metadata(self) -> dict:
+        return {
+            "title": self.title,
+            "authors": self.authors,
+            "series": self.series,
+            "series_index": self.series_index,
+        }
+
+    def write_cover(self, dst: str) -> bool:
+        """Записывает обложку в dst; False, если обложки нет"""
+        if not self.cover_bytes:
+            return False
+        with open(dst, "wb") as f:
+            f.write(self.cover_bytes)
+        return True
+
+
+def first_binary_image(path: str, min_size: int) -> Optional[bytes]:
+    """Первая картинка из <binary> не меньше min_size байт, потоковым проходом"""
+    for _, elem in etree.iterparse(path, events=("end",), tag="{*}binary", huge_tree=True):
+        if (elem.get("content-type") or "").startswith("image/") and elem.text:
+            try:
+                data = base64.b64decode(elem.text)
+            except ValueError:
+                data = b""
+            if len(data) > min_size:
+                return data
+        elem.clear()
+    return None
+
+
+def _text(elem) -> Optional[str]:
+    if elem is None or not elem.text:
+        return None
+    return elem.text.strip() or None
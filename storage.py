@@ -6,8 +6,20 @@ class UserSettings:
     def __init__(self, db_path: str = "data/settings.db"):
         Path("data").mkdir(exist_ok=True)
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # Кэш формата по user_id (write-through): чтение без обращения к SQLite
+        self._format_cache: dict[int, str] = {}
+        self._configure()
         self._init_db()
     
+    def _configure(self):
+        # WAL + synchronous=NORMAL: чтение не ждёт fsync, запись не блокирует чтение
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-8000;
+        """)
+    
     def _init_db(self):
         cursor = self.conn.cursor()
         cursor.execute("""
@@ -18,16 +30,31 @@ class UserSettings:
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS converted_books (
+                file_unique_id TEXT NOT NULL,
+                output_format TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                caption TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_unique_id, output_format)
+            )
+        """)
         self.conn.commit()
     
     def get_preferred_format(self, user_id: int) -> str:
+        cached = self._format_cache.get(user_id)
+        if cached is not None:
+            return cached
         cursor = self.conn.cursor()
         cursor.execute(
             "SELECT preferred_format FROM user_settings WHERE user_id = ?",
             (user_id,)
         )
         result = cursor.fetchone()
-        return result[0] if result else "azw3"
+        fmt = result[0] if result else "azw3"
+        self._format_cache[user_id] = fmt
+        return fmt
     
     def set_preferred_format(self, user_id: int, format: str):
         cursor = self.conn.cursor()
@@ -36,6 +63,39 @@ class UserSettings:
             VALUES (?, ?, CURRENT_TIMESTAMP)
         """, (user_id, format))
         self.conn.commit()
+        self._format_cache[user_id] = format
+    
+    def get_converted(self, file_unique_id: str, output_format: str) -> Optional[tuple[str, str]]:
+        """file_id и подпись уже отправленной конвертации этой же книги.
+
+        Ключ - file_unique_id загрузки или "b2:<BLAKE2b содержимого>"
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT file_id, caption FROM converted_books WHERE file_unique_id = ? AND output_format = ?",
+            (file_unique_id, output_format)
+        )
+        return cursor.fetchone()
+    
+    def save_converted(self, file_unique_id: str, output_format: str, file_id: str, caption: str):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO converted_books (file_unique_id, output_format, file_id, caption)
+            VALUES (?, ?, ?, ?)
+        """, (file_unique_id, output_format, file_id, caption))
+        self.conn.commit()
+    
+    def forget_converted(self, file_unique_id: str, output_format: str):
+        self.conn.execute(
+            "DELETE FROM converted_books WHERE file_unique_id = ? AND output_format = ?",
+            (file_unique_id, output_format)
+        )
+        self.conn.commit()
     
     def close(self):
+        # Переносим WAL в основной файл, чтобы следующий старт не делал recovery
+        try:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error:
+            pass
         self.conn.close()
\ No newline at end of file